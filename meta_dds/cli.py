@@ -4,16 +4,16 @@ License, v. 2.0. If a copy of the MPL was not distributed with this
 file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentError, ArgumentParser, Namespace
 from pathlib import Path
-from typing import Callable
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence, Tuple
 
-from semver import VersionInfo
-
-from meta_dds.package import (DDSDependency, FindPackageMap, Lib,
-                              MetaDependency, MetaPackageCMake)
+from meta_dds.errors import MetaDDSException
 from meta_dds.util import IfExists
 
+if TYPE_CHECKING:
+    from meta_dds.package import MetaPackageCMake
+
 
 def if_exists(parser: ArgumentParser, default: IfExists = IfExists.FAIL, *, help: str):
     parser.add_argument('--if-exists', type=IfExists, choices=IfExists,
@@ -37,6 +37,8 @@ def output(parser: ArgumentParser):
 
 
 def cmake_meta_info(parser: ArgumentParser):
+    from semver import VersionInfo
+
     cmake_opts = parser.add_argument_group(
         'CMake Project Options', description='Supply information on the package (if CMake). Default: inferred from the CMake project.')
     cmake_opts.add_argument(
@@ -59,24 +61,72 @@ def cmake_meta_info(parser: ArgumentParser):
         '--meta-depends', help="""A comma separated list of meta-dds dependencies formatted in the same manner as meta_package.json, i.e. either in the format of a DDS dependency or as a JSON5 object '{ name: DEP_NAME, configuration: { "CMAKE_CONFIG_VAR": "VALUE", ... } }'.""")
 
 
-def parse_cmake_meta_info(args: Namespace) -> MetaPackageCMake.Options:
+def parse_cmake_meta_info(args: Namespace) -> 'MetaPackageCMake.Options':
+    from meta_dds.package import (DDSDependency, FindPackageMap, Lib,
+                                  MetaDependency, MetaPackageCMake)
+
     return MetaPackageCMake.Options(
         name=args.name,
         namespace=args.namespace,
         version=args.pkg_version,
         find_package_map=FindPackageMap(
             find_package_name=args.find_package_name,
-            libs=[Lib.parse(dds_name.strip(), cmake_name.strip())
-                  for dds_name, cmake_name in (spec.split('=') for spec in args.libraries.split(','))]
+            libs=[Lib.parse(dds_name, cmake_name)
+                  for dds_name, cmake_name in _split_kv_list(args.libraries)]
             if args.libraries else [],
         ) if args.find_package_name else None,
-        depends=[DDSDependency.parse(x.strip()) for x in
-                 args.depends.split(',')] if args.depends else [],
-        meta_depends=[MetaDependency.parse(x.strip()) for x in
-                      args.meta_depends.split(',')] if args.meta_depends else [],
+        depends=list(map(DDSDependency.parse, map(str.strip, args.depends.split(','))))
+        if args.depends else [],
+        meta_depends=list(map(MetaDependency.parse, map(str.strip, args.meta_depends.split(','))))
+        if args.meta_depends else [],
     )
 
 
+class BadKeyValueList(MetaDDSException):
+    def __init__(self, message: str, spec: str):
+        self.spec = spec
+        super().__init__(message)
+
+
+def _split_kv_list(s: str) -> List[Tuple[str, str]]:
+    '''
+    Split 'K1=V1,K2=V2,...' into stripped (key, value) pairs
+    '''
+    result = []
+    for spec in s.split(','):
+        key, sep, value = spec.partition('=')
+        if not sep or '=' in value:
+            raise BadKeyValueList(f"Expected exactly one `=' in ``{spec}''", spec)
+        result.append((key.strip(), value.strip()))
+    return result
+
+
 def add_arguments(parser: ArgumentParser, *args: Callable[[ArgumentParser], None]):
     for arg in args:
         arg(parser)
+
+
+class _SubcommandSniffer(ArgumentParser):
+    def error(self, message: str):
+        # Leave reporting bad arguments to the real parser.
+        raise ArgumentError(None, message)
+
+
+def sniff_subcommand(argv: Sequence[str], *args: Callable[[ArgumentParser], None]) -> Tuple[Optional[str], List[str]]:
+    '''
+    Find which subcommand `argv` asks for without building every subcommand's
+    parser (and importing its module). `args` set up the options that may come
+    before the subcommand.
+
+    Returns the subcommand and the arguments which follow it.
+    '''
+    sniffer = _SubcommandSniffer(add_help=False)
+    add_arguments(sniffer, *args)
+    try:
+        _, rest = sniffer.parse_known_args(argv)
+    except ArgumentError:
+        return None, []
+    for i, arg in enumerate(rest):
+        if not arg.startswith('-'):
+            return arg, rest[i + 1:]
+    return None, []
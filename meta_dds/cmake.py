@@ -4,23 +4,33 @@ License, v. 2.0. If a copy of the MPL was not distributed with this
 file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
-import json
+import functools
 import logging
-import re
+import os
 import shlex
 import subprocess
 from argparse import ArgumentParser
 from dataclasses import dataclass
 from enum import Enum
+from hashlib import blake2b
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Sequence, Union
 
 from semver import VersionInfo
 
-from meta_dds import logutils
+from meta_dds import cli, jsonutils, logutils
+from meta_dds.errors import FileNotFound
+from meta_dds.tempfiles import write_text_atomic
 
 _logger = logging.getLogger(__name__)
+_TRACE = logutils.TRACE
+
+
+@functools.lru_cache(maxsize=None)
+def _detect_cmake_version(cmake_exe: str) -> VersionInfo:
+    version_output = subprocess.run(
+        [cmake_exe, '--version'], capture_output=True, check=True, text=True).stdout
+    return VersionInfo.parse(version_output.partition('version ')[2].split('\n', 1)[0].strip())
 
 
 @dataclass
@@ -32,10 +42,8 @@ class CMake:
 
     def __post_init__(self):
         if self.cmake_version is None:
-            version_output = subprocess.run(
-                [str(self.cmake_exe), '--version'], capture_output=True, check=True, text=True).stdout
-            object.__setattr__(self, 'cmake_version', VersionInfo.parse(
-                re.search(r'version (.*)', version_output).group(1)))
+            object.__setattr__(self, 'cmake_version',
+                               _detect_cmake_version(str(self.cmake_exe)))
 
             _logger.trace('Found CMake version %s: %s',
                           self.cmake_version, self.cmake_exe)
@@ -43,23 +51,26 @@ class CMake:
         self.build_dir = self.build_dir.resolve()
 
     def configure(self, args={}, quiet=False, toolchain: Optional[Path] = None):
-        cache_preload = self.build_dir / 'meta-dds-cmake-cache-preload.cmake'
         self.build_dir.mkdir(parents=True, exist_ok=True)
-        cache_preload.write_text(generate_preloaded_cache_script(args))
 
         cmd = [
             str(self.cmake_exe),
             '-S', str(self.source_dir),
             '-B', str(self.build_dir),
-            '-C', str(cache_preload)
         ]
+        # An empty preload script would do nothing, so skip writing it.
+        if args:
+            cache_preload = self.build_dir / 'meta-dds-cmake-cache-preload.cmake'
+            cache_preload.write_bytes(generate_preloaded_cache_script(args).encode('utf-8'))
+            cmd.extend(['-C', str(cache_preload)])
         if toolchain is not None:
             cmd.extend(['--toolchain', str(toolchain.resolve())])
 
-        _logger.trace('Configuring with command: %s%s%s',
-                      logutils.defer(lambda: shlex.join(cmd)),
-                      '\nAnd configuration values:\n' if args else '',
-                      logutils.defer(lambda: '\t\n'.join(f'{key}={value}' for key, value in args.items())))
+        if _logger.isEnabledFor(_TRACE):
+            _logger.trace('Configuring with command: %s%s%s',
+                          shlex.join(cmd),
+                          '\nAnd configuration values:\n' if args else '',
+                          '\t\n'.join(f'{key}={value}' for key, value in args.items()))
         if quiet:
             subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
         else:
@@ -70,8 +81,8 @@ class CMake:
         if target is not None:
             cmd += ['--target', target]
 
-        _logger.trace('Building with command: %s',
-                      logutils.defer(lambda: shlex.join(cmd)))
+        if _logger.isEnabledFor(_TRACE):
+            _logger.trace('Building with command: %s', shlex.join(cmd))
         subprocess.run(cmd, check=True)
 
 
@@ -104,37 +115,120 @@ class CMakeFileApiV1:
         return self.api_dir / 'reply'
 
     def reply_index_path(self) -> Path:
-        indices = sorted(f for f in self.reply_dir.iterdir() if f.is_file()
-                         and f.name.startswith('index-') and f.suffix == '.json')
-        _logger.trace('Found reply index at %s', indices[-1])
-        return indices[-1]
+        with os.scandir(self.reply_dir) as entries:
+            try:
+                index = max(entry.name for entry in entries
+                            if entry.name.startswith('index-') and entry.name.endswith('.json')
+                            and entry.is_file())
+            except ValueError:
+                raise FileNotFound(
+                    f'No CMake File API reply index in {self.reply_dir}', self.reply_dir) from None
+        _logger.trace('Found reply index at %s', index)
+        return self.reply_dir / index
 
     def query(self, *queries: List[FileApiQuery]) -> List[Path]:
         self.query_dir.mkdir(parents=True, exist_ok=True)
         for query in queries:
             self.query_dir.joinpath(query.value).touch(exist_ok=True)
 
-        _logger.trace('Querying CMake with %s', logutils.defer(
-            lambda: ', '.join(f"`{q.value}'" for q in queries)))
+        if _logger.isEnabledFor(_TRACE):
+            _logger.trace('Querying CMake with %s',
+                          ', '.join(f"`{q.value}'" for q in queries))
         self.cmake.configure(quiet=True)
 
         index_path = self.reply_index_path()
-        index = json.loads(index_path.read_text())
+        index = jsonutils.loads(index_path.read_bytes())
         replies = index['reply'][self.client_id]
 
-        return [json.loads(self.reply_dir.joinpath(replies[query.value]['jsonFile']).read_text()) for query in queries]
+        reply_dir = str(self.reply_dir)
+
+        def read_reply(query: FileApiQuery):
+            with open(os.path.join(reply_dir, replies[query.value]['jsonFile']), 'rb') as f:
+                return jsonutils.loads(f.read())
 
+        return [read_reply(query) for query in queries]
 
+    @property
+    def codemodel_cache_path(self) -> Path:
+        return self.cmake.build_dir / 'meta-dds-codemodel-cache.json'
+
+    def cached_codemodel(self) -> dict:
+        '''
+        Query the codemodel-v2 object, reusing the reply saved by an earlier
+        query if neither CMakeCache.txt nor any of the project's CMake files
+        have changed since. This skips re-running CMake.
+        '''
+        key = _cmake_cache_key(self.cmake.build_dir)
+        if key is not None:
+            try:
+                cached = jsonutils.loads(self.codemodel_cache_path.read_bytes())
+            except FileNotFoundError:
+                pass
+            else:
+                # CMake deletes reply files that the current index no longer refers to.
+                if (cached['key'] == key
+                        and _input_mtimes(cached['inputs']) == cached['inputs']
+                        and _replies_exist(self.reply_dir, cached['codemodel'])):
+                    _logger.trace('Reusing cached codemodel %s', key)
+                    return cached['codemodel']
+
+        codemodel, cmake_files = self.query(
+            FileApiQuery.CODEMODEL_V2, FileApiQuery.CMAKEFILES_V1)
+
+        # Configuring may have (re)written CMakeCache.txt.
+        key = _cmake_cache_key(self.cmake.build_dir)
+        if key is not None:
+            source_dir = cmake_files['paths']['source']
+            inputs = _input_mtimes({
+                os.path.join(source_dir, input['path']): None
+                for input in cmake_files['inputs']
+                # CMake's own modules only change along with CMake (and thus CMakeCache.txt).
+                if not input.get('isCMake') and not input.get('isGenerated')
+            })
+            # Only the latest configuration is kept, so the cache can't grow without bound.
+            # A concurrent reader must never see a partial file.
+            write_text_atomic(self.codemodel_cache_path, jsonutils.dumps(
+                {'key': key, 'inputs': inputs, 'codemodel': codemodel}))
+
+        return codemodel
+
+
+def _cmake_cache_key(build_dir: Path) -> Optional[str]:
+    try:
+        return blake2b(build_dir.joinpath('CMakeCache.txt').read_bytes(), digest_size=16).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _replies_exist(reply_dir: Path, codemodel: dict) -> bool:
+    return all(os.path.isfile(os.path.join(reply_dir, obj['jsonFile']))
+               for configuration in codemodel['configurations']
+               for kind in ('directories', 'targets')
+               for obj in configuration.get(kind, ()))
+
+
+def _input_mtimes(inputs: Iterable[str]) -> Dict[str, Optional[int]]:
+    mtimes = {}
+    for input in inputs:
+        try:
+            mtimes[input] = os.stat(input).st_mtime_ns
+        except FileNotFoundError:
+            mtimes[input] = None
+    return mtimes
+
+
+@functools.lru_cache(maxsize=None)
 def default_configure_args(cmake_version: VersionInfo) -> Dict[str, str]:
+    '''
+    The returned dict is shared between callers; copy it before modifying.
+    '''
     return {
         # Deprecated option 3.16+:
         'CMAKE_FIND_PACKAGE_NO_PACKAGE_REGISTRY': 'YES',
         'CMAKE_FIND_PACKAGE_NO_SYSTEM_PACKAGE_REGISTRY': 'YES',
-        'CMAKE_FIND_PACKAGE_NO_PACKAGE_REGISTRY': 'YES',
         # Replaced by:
         'CMAKE_FIND_USE_PACKAGE_REGISTRY': 'NO',
         'CMAKE_FIND_USE_SYSTEM_PACKAGE_REGISTRY': 'NO',
-        'CMAKE_FIND_USE_PACKAGE_REGISTRY': 'NO',
 
         # Other options
         'CMAKE_FIND_USE_CMAKE_ENVIRONMENT_PATH': 'NO',
@@ -151,17 +245,25 @@ def default_configure_args(cmake_version: VersionInfo) -> Dict[str, str]:
     }
 
 
-def generate_preloaded_cache_script(cache_values: Dict[str, str]) -> str:
-    return '\n'.join(f'set({key} [======[{value}]======] CACHE STRING "")' for key, value in cache_values.items())
+_PRELOADED_CACHE_ENTRY = 'set({} [======[{}]======] CACHE STRING "")'.format
 
 
-def setup_parser(parser: ArgumentParser):
-    # Prevents circular import error; only used for setting up argparse.
-    from meta_dds import cmake_forge_sdist
+def generate_preloaded_cache_script(cache_values: Dict[str, str]) -> str:
+    # A list (rather than a generator) lets join size its result up front.
+    return '\n'.join([_PRELOADED_CACHE_ENTRY(key, value) for key, value in cache_values.items()])
 
+
+def setup_parser(parser: ArgumentParser, argv: Sequence[str] = ()):
     subparsers = parser.add_subparsers()
+    chosen, _ = cli.sniff_subcommand(argv)
+
+    # Always registered so that `--help' lists it; only wired up when used.
+    forge_sdist = subparsers.add_parser(
+        'forge-sdist', help='Instantiate a toolchain-dependent sdist from a Meta-DDS or CMake project.')
+    if chosen == 'forge-sdist':
+        # Prevents circular import error; only used for setting up argparse.
+        from meta_dds import cmake_forge_sdist
 
-    cmake_forge_sdist.setup_parser(subparsers.add_parser(
-        'forge-sdist', help='Instantiate a toolchain-dependent sdist from a Meta-DDS or CMake project.'))
+        cmake_forge_sdist.setup_parser(forge_sdist)
 
     # TODO: Full CMake project sdist porter subcommand. A command that has none of this meta-sdist stuff.
@@ -24,20 +24,22 @@ _logger = logging.getLogger(__name__)
 
 
 def forge(project: Path, output: Path, toolchain: Optional[str], scratch_dir: Path = None,
-          options: Optional[MetaPackageCMake.Options] = None, if_exists: IfExists = IfExists.FAIL):
+          options: Optional[MetaPackageCMake.Options] = None, if_exists: IfExists = IfExists.FAIL,
+          clean_scratch: bool = False):
     toolchain: DDSToolchain = get_dds_toolchain(toolchain)
     cmake_toolchain_contents: str = generate_toolchain(toolchain)
 
-    with TemporaryDirectory(scratch_dir=scratch_dir) as d:
+    with TemporaryDirectory(scratch_dir=scratch_dir, clean=clean_scratch) as d:
         sdist_template = CMakeSDistTemplate(name=None, cmakelists_dir=project, options=options, scratch_dir=d / 'cmake')
         sdist: SDist = sdist_template.instantiate(toolchain, d)
 
-        exes.dds.pkg().create(project=sdist.project_root, output=output, if_exists=if_exists)
+        exes.dds.pkg_create(project=sdist.project_root, output=output, if_exists=if_exists)
 
 
 def forge_main(args: Namespace):
     forge(args.project, args.output, args.toolchain,
-          scratch_dir=args.scratch_dir, options=cli.parse_cmake_meta_info(args), if_exists=args.if_exists)
+          scratch_dir=args.scratch_dir, options=cli.parse_cmake_meta_info(args), if_exists=args.if_exists,
+          clean_scratch=args.clean_scratch)
 
 
 def setup_parser(parser: ArgumentParser):
@@ -46,4 +48,6 @@ def setup_parser(parser: ArgumentParser):
     cli.if_exists(parser, help='What to do if the sdist tar.gz already exists')
     parser.add_argument('--scratch-dir', type=Path, default=None,
                         help='Path to configure as a CMake build directory in the process of forging an sdist')
+    parser.add_argument('--clean-scratch', action='store_true',
+                        help='Remove the contents of --scratch-dir before use rather than reusing the previous build')
     parser.set_defaults(func=forge_main)
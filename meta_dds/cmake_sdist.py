@@ -5,18 +5,20 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 import shutil
-import json
 import difflib
 import logging
 import dataclasses
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional, Iterable
+from functools import cached_property
+from typing import Iterable, List, Optional
 from pathlib import Path
-from hashlib import sha256
+from hashlib import blake2b
 
-from meta_dds import exes
+from meta_dds import exes, jsonutils
 from meta_dds.errors import MetaDDSException
-from meta_dds.cmake import CMakeFileApiV1, FileApiQuery
+from meta_dds.cmake import CMakeFileApiV1
 from meta_dds.tempfiles import TemporaryDirectory
 from meta_dds.sdist import SDistTemplate, ToolchainSpecificSDist
 from meta_dds.toolchain import DDSToolchain, generate_toolchain
@@ -26,7 +28,18 @@ _logger = logging.getLogger(__name__)
 
 class NotACMakeTarget(MetaDDSException):
     def __init__(self, cmake_target: str, cmake_targets: Iterable[str]):
-        close = difflib.get_close_matches(cmake_target, cmake_targets)
+        self.cmake_target = cmake_target
+        self.cmake_targets = list(cmake_targets)
+
+        super().__init__(cmake_target)
+
+    @cached_property
+    def close_matches(self) -> List[str]:
+        # Fuzzy matching is slow for large projects; only do it if the message is wanted.
+        return difflib.get_close_matches(self.cmake_target, self.cmake_targets)
+
+    def __str__(self) -> str:
+        close = self.close_matches
         did_you_mean = ''
         if close:
             if len(close) == 1:
@@ -35,13 +48,17 @@ class NotACMakeTarget(MetaDDSException):
                 did_you_mean = f" Did you mean one of `{close[0]}' or `{close[1]}'?"
             else:
                 close_quoted = [f"`{x}'" for x in close[:-1]]
-                did_you_mean = f" Did you mean one of {', '.join(close_quoted)}, or {close_quoted[-1]}?"
+                did_you_mean = f" Did you mean one of {', '.join(close_quoted)}, or `{close[-1]}'?"
+
+        return f"Could not find `{self.cmake_target}' in the CMake project.{did_you_mean}"
 
-        self.cmake_target = cmake_target
-        self.close_matches = close
 
-        super().__init__(
-            f"Could not find `{cmake_target}' in the CMake project.{did_you_mean}")
+# These files have a fixed shape, so format them directly; only the (JSON
+# encoded) values vary. Laid out like `json.dumps(..., indent=2)`, though
+# non-ASCII characters may be written as UTF-8 rather than \u escapes.
+_PACKAGE_JSON = ('{{\n  "name": {name},\n  "namespace": {namespace},\n  "version": {version},\n'
+                 '  "depends": {depends}\n}}').format
+_LIBRARY_JSON = '{{\n  "name": {name}\n}}'.format
 
 
 @dataclass
@@ -58,26 +75,41 @@ class CMakeSDistTemplate(SDistTemplate):
             cmake_exe = dataclasses.replace(
                 exes.cmake, source_dir=self.cmakelists_dir, build_dir=scratch_dir / 'cmake_build')
             cmake_toolchain = scratch_dir / 'toolchain.cmake'
-            cmake_toolchain.write_text(cmake_toolchain_contents)
+            # Leave an up to date toolchain untouched; its mtime is part of the codemodel cache key.
+            try:
+                up_to_date = cmake_toolchain.read_text() == cmake_toolchain_contents
+            except FileNotFoundError:
+                up_to_date = False
+            if not up_to_date:
+                cmake_toolchain.write_text(cmake_toolchain_contents)
 
             cmake_exe.configure(toolchain=cmake_toolchain)
 
-            pkg = MetaPackageCMake.load(cmake_exe, self.options)
+            file_api = CMakeFileApiV1(cmake_exe, 'meta-dds')
+            codemodel = file_api.cached_codemodel()
+
+            pkg = MetaPackageCMake.load(cmake_exe, self.options, codemodel)
 
             dds_pkg_dir = tmp_dir / 'dds_pkg'
-            dds_pkg_dir.mkdir(exist_ok=True)
+            # tmp_dir may be a reused scratch directory; don't package stale files.
+            if dds_pkg_dir.exists():
+                shutil.rmtree(dds_pkg_dir)
+            dds_pkg_dir.mkdir()
             dds_pkg_lib_dir = dds_pkg_dir / 'libs'
             dds_pkg_lib_dir.mkdir(exist_ok=True)
 
-            dds_pkg_dir.joinpath('package.json').write_text(json.dumps({
-                'name': pkg.info.pkg_id.name,
-                'namespace': pkg.info.pkg_id.namespace,
-                'version': str(pkg.info.version),
-                # TODO: the rest of it
-            }, indent=2))
+            dds_pkg_dir.joinpath('package.json').write_text(_PACKAGE_JSON(
+                name=jsonutils.dumps(pkg.info.pkg_id.name),
+                namespace=jsonutils.dumps(pkg.info.pkg_id.namespace),
+                version=jsonutils.dumps(str(pkg.info.version)),
+                # Meta-dependencies are imported as DDS packages of the same name, so DDS
+                # must resolve them too. Nested one level, hence the extra indentation.
+                depends=jsonutils.dumps(
+                    [str(dep) for dep in pkg.info.depends]
+                    + [str(meta_dep.dep) for meta_dep in pkg.info.meta_depends],
+                    indent=2).replace('\n', '\n  '),
+            ), encoding='utf-8')
 
-            file_api = CMakeFileApiV1(cmake_exe, 'meta-dds')
-            codemodel, = file_api.query(FileApiQuery.CODEMODEL_V2)
             targets = next(iter(codemodel['configurations']))['targets']
             targets_map = {target['name']: target for target in targets}
             _logger.trace('Found CMake targets: %s', targets_map)
@@ -91,17 +123,29 @@ class CMakeSDistTemplate(SDistTemplate):
                 _logger.info("Inferred library map of DDS `%s' -> CMake `%s'",
                              pkg_libs[0].dds_name, pkg_libs[0].cmake_name)
 
+            # Resolve every target up front so that bad library maps fail before any work is done.
+            lib_target_infos = []
+            target_infos = {}
+            reply_dir = file_api.reply_dir
             for lib in pkg_libs:
                 try:
                     cmake_target = targets_map[lib.cmake_name]
                 except KeyError:
                     raise NotACMakeTarget(lib.cmake_name, targets_map.keys())
 
+                # Several libraries may map onto the same target; parse each reply once.
+                target_json_file = cmake_target['jsonFile']
+                target_info = target_infos.get(target_json_file)
+                if target_info is None:
+                    target_info = target_infos[target_json_file] = jsonutils.loads(
+                        reply_dir.joinpath(target_json_file).read_bytes())
+                lib_target_infos.append(target_info)
+
+            def write_lib(lib: Lib, target_info: dict):
                 lib_dir = dds_pkg_lib_dir / lib.dds_name
                 lib_dir.mkdir(exist_ok=True)
-                lib_dir.joinpath('library.json').write_text(json.dumps({
-                    'name': lib.dds_name,
-                }, indent=2))
+                lib_dir.joinpath('library.json').write_text(
+                    _LIBRARY_JSON(name=jsonutils.dumps(lib.dds_name)), encoding='utf-8')
 
                 inc_dir = lib_dir / 'include'
                 src_dir = lib_dir / 'src'
@@ -109,57 +153,61 @@ class CMakeSDistTemplate(SDistTemplate):
                 inc_dir.mkdir(exist_ok=True)
                 src_dir.mkdir(exist_ok=True)
 
-                target_info = json.loads(file_api.reply_dir.joinpath(
-                    cmake_target['jsonFile']).read_text())
                 compile_groups = target_info['compileGroups']
 
                 defines = []  # Any -D...s that we have to add
+                define_files = {}  # Compile groups with identical defines share one header
                 for compile_info in compile_groups:
                     if 'defines' in compile_info:
-                        def_str_builder = ['#pragma once']
-                        for define in compile_info['defines']:
-                            define = define['define']
-                            if '=' in define:
-                                # `=` is not part of a valid identifier. Thus, if present, the first must denote the value of the preprocessor definition.
-                                name, value = define.split('=', maxsplit=2)
-                            else:
-                                name = define
-                                value = ''
-                            def_str_builder.append(f'#define {name} {value}')
-
-                        def_str = '\n'.join(def_str_builder)
-                        hash = sha256(def_str.encode('utf-8')).hexdigest()
-                        define_file = src_dir / \
-                            f'meta-dds.{pkg_name}.{hash}.predefine.h'
-                        define_file.write_text(def_str)
+                        # `=` is not part of a valid identifier. Thus, if present, the first must denote the value of the preprocessor definition.
+                        def_str = '\n'.join(['#pragma once'] + [
+                            f'#define {name} {value}' for name, _, value in
+                            (define['define'].partition('=') for define in compile_info['defines'])])
+
+                        define_file = define_files.get(def_str)
+                        if define_file is None:
+                            # Only names the file, so it need not be cryptographic.
+                            hash = blake2b(def_str.encode('utf-8'), digest_size=16).hexdigest()
+                            define_file = define_files[def_str] = src_dir / \
+                                f'meta-dds.{pkg_name}.{hash}.predefine.h'
+                            define_file.write_text(def_str)
 
                         defines.append(define_file)
                     else:
                         defines.append(None)
 
-                include_dirs = sum(
-                    (compile_info['includes'] for compile_info in compile_groups), start=[])
+                # Compile groups commonly share include directories; copy each only once.
+                include_dirs = dict.fromkeys(include['path'] for compile_info in compile_groups
+                                             for include in compile_info['includes'])
                 for include in include_dirs:
-                    include_dir = Path(include['path'])
+                    include_dir = Path(include)
                     assert include_dir.is_absolute()
                     shutil.copytree(include_dir, inc_dir, dirs_exist_ok=True)
 
-                sources = [src for src in target_info['sources']
-                           if 'compileGroupIndex' in src]
-                for source in sources:
-                    source_path = main_src_dir.joinpath(source['path'])
+                # (source, destination, compile group index), resolved once
+                sources = [(main_src_dir / source['path'], src_dir / source['path'], source['compileGroupIndex'])
+                           for source in target_info['sources'] if 'compileGroupIndex' in source]
+                # Create each destination directory once rather than once per source.
+                for dst_dir in {dst_path.parent for _, dst_path, _ in sources}:
+                    os.makedirs(dst_dir, exist_ok=True)
+
+                for source_path, dst_path, compile_group_index in sources:
                     assert source_path.is_file(), 'Cannot package build-time generated source files yet'
-                    dst_path = src_dir.joinpath(source['path'])
                     _logger.trace("Copying source file `%s' to `%s'",
-                                  source['path'], dst_path)
-                    dst_path.parent.mkdir(parents=True, exist_ok=True)
-                    compile_group_index = source['compileGroupIndex']
-                    shutil.copy(source_path, dst_path)
-
-                    if defines[compile_group_index]:
-                        dst_text = dst_path.read_text()
-                        dst_path.write_text(
-                            f'#include "{defines[compile_group_index].name}"\n' + dst_text)
+                                  source_path, dst_path)
+                    define_file = defines[compile_group_index]
+                    if define_file:
+                        # Write the #include and the source in a single pass.
+                        with open(source_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                            dst.write(f'#include "{define_file.name}"\n'.encode('utf-8'))
+                            shutil.copyfileobj(src, dst)
+                    else:
+                        shutil.copy(source_path, dst_path)
+
+            # Libraries are written to disjoint directories, and the work is almost all file I/O.
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+                # list() re-raises any exception from the workers.
+                list(pool.map(write_lib, pkg_libs, lib_target_infos))
 
         return ToolchainSpecificSDist(name=pkg_name, project_root=dds_pkg_dir)
 
@@ -11,7 +11,6 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import List
 
-from meta_dds import logutils
 from meta_dds.errors import MetaDDSException
 from meta_dds.util import IfExists
 
@@ -26,20 +25,14 @@ class DDSRunFailed(MetaDDSException):
 class DDS:
     dds_exe: Path
 
-    def pkg(self):
-        dds = self
-
-        class Pkg:
-            def create(self, *, project: Path, output: Path, if_exists: IfExists):
-                dds._run(['pkg', 'create', '--project', str(project),
-                          '--output', str(output), '--if-exists', if_exists.value])
-
-        return Pkg()
+    def pkg_create(self, *, project: Path, output: Path, if_exists: IfExists):
+        self._run(['pkg', 'create', '--project', str(project),
+                   '--output', str(output), '--if-exists', if_exists.value])
 
     def _run(self, cmd: List[str]):
         cmd = [str(self.dds_exe)] + cmd
-        _logger.debug('Running DDS as: %s', logutils.defer(
-            lambda: shlex.join(cmd)))
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug('Running DDS as: %s', shlex.join(cmd))
 
         try:
             subprocess.run(cmd, check=True)
@@ -0,0 +1,70 @@
+'''
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+'''
+
+'''
+JSON reading and writing, using orjson when it is installed and the standard
+json module otherwise. JSON5 is parsed with json5.
+'''
+
+import json
+import re
+from typing import Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(s: Union[str, bytes]) -> Any:
+    '''
+    Parse JSON. Prefer passing bytes (e.g. `Path.read_bytes()`), which skips a
+    separate UTF-8 decoding pass.
+    '''
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+def loads_json5(s: Union[str, bytes]) -> Any:
+    '''
+    Parse JSON5. Most JSON5 files are plain JSON, so try the (much faster) JSON
+    parser first and only fall back to the pure Python json5 parser if needed.
+    '''
+    try:
+        return loads(s)
+    except ValueError:  # Includes both json's and orjson's JSONDecodeError
+        return _loads_json5(s)
+
+
+# Strings are matched too, so that comment markers inside them are kept.
+_JSONC_TOKEN_RE = re.compile(rb'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)
+
+
+def loads_jsonc(s: Union[str, bytes]) -> Any:
+    '''
+    Parse JSON with comments. The comments are stripped so that the JSON
+    parser can be used, falling back to json5 for anything else non-standard.
+    '''
+    data = s.encode('utf-8') if isinstance(s, str) else s
+    try:
+        # Comments become a space, so that they still separate tokens.
+        return loads(_JSONC_TOKEN_RE.sub(lambda m: m.group(1) or b' ', data))
+    except ValueError:
+        return _loads_json5(s)
+
+
+def _loads_json5(s: Union[str, bytes]) -> Any:
+    import json5
+
+    return json5.loads(s.decode('utf-8') if isinstance(s, bytes) else s)
+
+
+def dumps(obj: Any, indent: Optional[int] = None) -> str:
+    # orjson only knows how to indent by two spaces.
+    if orjson is not None and indent in (None, 2):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+    return json.dumps(obj, indent=indent)
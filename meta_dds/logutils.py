@@ -4,6 +4,7 @@ License, v. 2.0. If a copy of the MPL was not distributed with this
 file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
+import functools
 import logging
 import sys
 from enum import Enum, auto
@@ -15,7 +16,12 @@ class defer:
         self.action = action
 
     def __str__(self):
-        return self.action()
+        # Formatted at most once, even if several handlers emit the record.
+        try:
+            return self._result
+        except AttributeError:
+            self._result = self.action()
+            return self._result
 
 
 # From https://stackoverflow.com/a/35804945
@@ -74,6 +80,7 @@ def __addLoggingLevel(levelName, levelNum, methodName=None):
 
 
 __addLoggingLevel('TRACE', logging.DEBUG - 5)
+TRACE = logging.TRACE
 
 
 _META_DDS_LOG_FORMAT = '[{levelname}] [{name:<20}] {message}'
@@ -83,14 +90,19 @@ _ADJUST_LEVEL = '{:<5}'
 class MetaDDSFormatter(Formatter):
     def __init__(self, fmt: str = _META_DDS_LOG_FORMAT, style: str = '{'):
         super().__init__(fmt=fmt, style=style)
+        # Level names are formatted for every record, so do it once up front.
+        self._levelnames = {levelno: self._format_levelname(levelno, logging.getLevelName(levelno))
+                            for levelno in _COLORMAP}
 
     def format(self, record: LogRecord):
-        record.levelname = _ADJUST_LEVEL.format(record.levelname.lower())
-        record = self._post_adjust(record)
+        levelname = self._levelnames.get(record.levelno)
+        if levelname is None:
+            levelname = self._format_levelname(record.levelno, record.levelname)
+        record.levelname = levelname
         return super().format(record)
 
-    def _post_adjust(self, record: LogRecord) -> LogRecord:
-        return record
+    def _format_levelname(self, levelno: int, levelname: str) -> str:
+        return _ADJUST_LEVEL.format(levelname.lower())
 
 
 _RESET = '\033[m'
@@ -122,19 +134,32 @@ class ColoredMetaDDSFormatter(MetaDDSFormatter):
     def __init__(self, fmt: str = _META_DDS_LOG_FORMAT, style: str = '{'):
         super().__init__(fmt=fmt, style=style)
 
-    def _post_adjust(self, record: LogRecord) -> LogRecord:
-        record.levelname = _colored(
-            _COLORMAP[record.levelno], record.levelname)
-        return record
+    def _format_levelname(self, levelno: int, levelname: str) -> str:
+        return _colored(_COLORMAP.get(levelno, ''),
+                        super()._format_levelname(levelno, levelname))
 
 
 class ColorMode(Enum):
     NO = auto()
     YES = auto()
-    AUTO = YES if sys.stderr.isatty() else NO
+    AUTO = auto()
+
+    def resolve(self) -> 'ColorMode':
+        '''
+        Turn AUTO into YES or NO depending on whether stderr is a terminal
+        '''
+        if self is ColorMode.AUTO:
+            return _auto_color_mode()
+        return self
+
+
+@functools.lru_cache(maxsize=None)
+def _auto_color_mode() -> ColorMode:
+    return ColorMode.YES if sys.stderr.isatty() else ColorMode.NO
 
 
 def get_formatter(mode: ColorMode) -> Formatter:
+    mode = mode.resolve()
     if mode is ColorMode.NO:
         return MetaDDSFormatter()
     else:
@@ -5,18 +5,19 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 import argparse
+import importlib
 import logging
 import shutil
+import sys
 from pathlib import Path
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tempfile import TemporaryDirectory
 from typing import Optional
 
-from meta_dds import (cli, cmake, errors, exes, logutils, pkg_create, repoman,
-                      setup)
-from meta_dds import toolchain as tc
-from meta_dds.cmake import CMake, CMakeFileApiV1, FileApiQuery
+from meta_dds import cli, cmake, errors, exes, logutils
+from meta_dds.cmake import CMake, CMakeFileApiV1
 from meta_dds.dds_exe import DDS
 from meta_dds.errors import MetaDDSException
+from meta_dds.tempfiles import write_text_atomic
 
 logger = logging.getLogger(__name__)
 
@@ -24,12 +25,22 @@ logger = logging.getLogger(__name__)
 def run_setup(toolchain: Optional[str], project: Path, output: Path):
     assert toolchain.is_file()
     assert project.is_dir()
-    output.mkdir(exist_ok=True)
     gen_proj = output / '_project'
-    gen_proj.mkdir(exist_ok=True)
 
     gen_toolchain = gen_proj / f'toolchain{toolchain.suffix}'
-    shutil.copy(toolchain, gen_toolchain)
+    # Leave an up to date copy untouched, so that its mtime doesn't trigger rebuilds.
+    try:
+        up_to_date = gen_toolchain.read_bytes() == toolchain.read_bytes()
+    except FileNotFoundError:
+        # The directories can only be missing if the toolchain was never staged.
+        output.mkdir(exist_ok=True)
+        gen_proj.mkdir(exist_ok=True)
+        up_to_date = False
+    if not up_to_date:
+        # A copy staged by an older version may be a hard link to the user's
+        # toolchain; writing through it would change their file too.
+        gen_toolchain.unlink(missing_ok=True)
+        shutil.copyfile(toolchain, gen_toolchain)
 
 
 def setup_main(args: argparse.Namespace):
@@ -37,66 +48,94 @@ def setup_main(args: argparse.Namespace):
 
 
 def run_cmake(cmake_exe: Path, project: Path, output: Path, toolchain: Optional[str]):
+    from meta_dds import toolchain as tc
+
     cmake_exe = CMake(cmake_exe=cmake_exe, source_dir=project,
                       build_dir=output / '_cmake_build')
     configure_args = cmake.default_configure_args(cmake_exe.cmake_version)
 
-    toolchain_contents = cmake.generate_toolchain(
+    toolchain_contents = tc.generate_toolchain(
         tc.get_dds_toolchain(toolchain))
     tc_file = output / 'cmake_toolchain.cmake'
-    if not tc_file.exists() or tc_file.read_text() != toolchain_contents:
+    try:
+        old_contents = tc_file.read_text()
+    except FileNotFoundError:
+        old_contents = None
+    if old_contents != toolchain_contents:
         logger.debug('%s toolchain file',
-                     'Updating' if tc_file.exists() else 'Creating')
+                     'Creating' if old_contents is None else 'Updating')
         tc_file.parent.mkdir(parents=True, exist_ok=True)
-        tc_file.write_text(toolchain_contents)
+        # CMake must never see a partially written toolchain.
+        write_text_atomic(tc_file, toolchain_contents)
 
     cmake_exe.configure(configure_args, toolchain=tc_file)
 
     cmake_query = CMakeFileApiV1(cmake=cmake_exe, client='meta-dds')
 
-    codemodel, = cmake_query.query(FileApiQuery.CODEMODEL_V2)
+    cmake_query.cached_codemodel()
 
 
 def cmake_main(args: argparse.Namespace):
     run_cmake(args.cmake_exe, args.project, args.output, args.toolchain)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        prog='meta-dds', description='Source tree reifying DDS wrapper')
+_LOG_LEVELS = {
+    'trace': logging.TRACE,
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warn': logging.WARN,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+    'silent': logging.NOTSET,
+}
+
+
+def _global_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--cmake', default='cmake', dest='cmake_exe',
                         help='The path to the CMake executable.')
     parser.add_argument('--dds', default='dds', dest='dds_exe',
                         help='The path to the DDS executable.')
-    parser.add_argument('--log-level', default='info', choices=('trace', 'debug', 'info',
-                                                                'warn', 'error', 'critical', 'silent'),
+    parser.add_argument('--log-level', default='info', choices=_LOG_LEVELS.keys(),
                         help='Set the meta-dds logging level.')
     parser.add_argument('--color', '--colour', default='auto', choices=('no', 'yes', 'auto'),
                         help='Add color to meta-dds logging output. Default: auto (detect if terminal supports color).')
-    subparsers = parser.add_subparsers()
 
-    setup.setup_parser(subparsers.add_parser(
-        'setup', help='Setup the project source tree.'))
-    # cli.add_arguments(setup, cli.toolchain, cli.project, cli.output)
-    # setup.set_defaults(func=setup_main)
 
+# (name, module providing setup_parser(), help)
+_SUBCOMMANDS = (
+    ('setup', 'meta_dds.setup', 'Setup the project source tree.'),
     # Maybe this "cmake" command = try to create a regular DDS sdist from a cmake project
-    cmake.setup_parser(subparsers.add_parser(
-        'cmake', help='Create sdists from CMake projects'))
+    ('cmake', 'meta_dds.cmake', 'Create sdists from CMake projects'),
+    ('pkg-create', 'meta_dds.pkg_create',
+     'Package a Meta-DDS or CMake project into a meta-source-dist.'),
+    ('repoman', 'meta_dds.repoman', 'Manage a Meta-DDS package repository.'),
+)
+
 
-    pkg_create.setup_parser(subparsers.add_parser(
-        'pkg-create', help='Package a Meta-DDS or CMake project into a meta-source-dist.'))
+def main():
+    parser = argparse.ArgumentParser(
+        prog='meta-dds', description='Source tree reifying DDS wrapper')
+    _global_arguments(parser)
+    subparsers = parser.add_subparsers()
 
-    repoman.setup_parser(subparsers.add_parser(
-        'repoman', help='Manage a Meta-DDS package repository.'))
+    # Every subcommand is listed so that `--help' shows it, but only the chosen
+    # one has its arguments set up.
+    chosen, subcommand_argv = cli.sniff_subcommand(sys.argv[1:], _global_arguments)
+    for name, module, help in _SUBCOMMANDS:
+        subparser = subparsers.add_parser(name, help=help)
+        if name == chosen:
+            importlib.import_module(module).setup_parser(subparser, subcommand_argv)
+    # cli.add_arguments(setup, cli.toolchain, cli.project, cli.output)
+    # setup.set_defaults(func=setup_main)
 
     args = parser.parse_args()
 
     if args.log_level != 'silent':
-        logging.basicConfig(level=_map_log_level(args.log_level))
+        log_level = _map_log_level(args.log_level)
+        logging.basicConfig(level=log_level)
         logging.root.handlers.clear()
         handler = logging.StreamHandler()
-        handler.setLevel(_map_log_level(args.log_level))
+        handler.setLevel(log_level)
         handler.setFormatter(logutils.get_formatter(
             logutils.ColorMode[args.color.upper()]))
         logging.root.addHandler(handler)
@@ -122,15 +161,7 @@ def main():
 
 
 def _map_log_level(name: str) -> int:
-    return {
-        'trace': logging.TRACE,
-        'debug': logging.DEBUG,
-        'info': logging.INFO,
-        'warn': logging.WARN,
-        'error': logging.ERROR,
-        'critical': logging.CRITICAL,
-        'silent': logging.NOTSET,
-    }[name]
+    return _LOG_LEVELS[name]
 
 
 if __name__ == '__main__':
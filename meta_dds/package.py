@@ -5,24 +5,37 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 import dataclasses
-import json
+import functools
 import logging
+import os
 import re
 from abc import ABC
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple, TypedDict, Union
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple, TypedDict, Union
 
-import json5
-from semver import VersionInfo
-
-from meta_dds import exes, util
-from meta_dds.cmake import CMake, CMakeFileApiV1, FileApiQuery
+from meta_dds import exes, jsonutils, util
+from meta_dds.cmake import CMake, CMakeFileApiV1
 from meta_dds.errors import MetaDDSException
 from meta_dds.logutils import EXIT_INTERNAL_ERROR
 
+if TYPE_CHECKING:
+    # semver is imported where it is needed, so that commands
+    # which never parse a package don't pay for importing it.
+    from semver import VersionInfo
+
 _logger = logging.getLogger(__name__)
 
+_PROJECT_VERSION_RE = re.compile(rb'CMAKE_PROJECT_VERSION:STATIC=(.*?)\r?$')
+
+
+@functools.lru_cache(maxsize=2048)
+def _parse_version(version: str) -> 'VersionInfo':
+    # The same versions are parsed over and over; VersionInfo is immutable, so share them.
+    from semver import VersionInfo
+
+    return VersionInfo.parse(version)
+
 
 class BadPackageConfiguration(MetaDDSException):
     def __init__(self, message: str, project: Optional[Path] = None):
@@ -67,7 +80,7 @@ MetaPackageJSONDict = dict
 DDSPackageJSONDict = dict
 
 
-@dataclass
+@dataclass(frozen=True)
 class PackageID:
     namespace: str
     name: str
@@ -76,14 +89,18 @@ class PackageID:
         return f'{self.namespace}::{self.name}'
 
 
-@dataclass
+@dataclass(frozen=True)
 class Lib:
     dds_name: str
     cmake_name: str
 
     @staticmethod
+    # The same libraries show up in many packages' dependencies; parse each once.
+    # Safe to share, as Lib is immutable.
+    @functools.lru_cache(maxsize=1024)
     def parse(dds_name: str, cmake_name: str) -> 'Lib':
-        if cmake_name.count('::') > 1:
+        first = cmake_name.find('::')
+        if first != -1 and cmake_name.find('::', first + 2) != -1:
             raise BadCMakeLibSpecifier(
                 f"Only one `::' allowed in CMake library. Given: ``{cmake_name}''", cmake_name)
 
@@ -92,6 +109,8 @@ class Lib:
 
 @dataclass
 class FindPackageMap:
+    __slots__ = ('find_package_name', 'libs')
+
     find_package_name: str
     libs: List[Lib]
 
@@ -110,15 +129,17 @@ class FindPackageMap:
         return {lib.dds_name: lib.cmake_name for lib in self.libs}
 
 
-@dataclass
+@dataclass(frozen=True)
 class DDSDependency:
     pkg_id: PackageID
-    version: VersionInfo
+    version: 'VersionInfo'
 
     @staticmethod
+    # Dependencies are shared by many packages, and VersionInfo.parse isn't cheap.
+    @functools.lru_cache(maxsize=1024)
     def parse(id: str) -> 'DDSDependency':
         name, version_str = id.split('@', maxsplit=1)
-        return DDSDependency(PackageID(None, name), VersionInfo.parse(version_str))
+        return DDSDependency(PackageID(None, name), _parse_version(version_str))
 
     def __str__(self) -> str:
         return f'{self.pkg_id.name}@{self.version}'
@@ -138,6 +159,8 @@ class MetaDependency:
         name: str
         configuration: Dict[str, str]
 
+    __slots__ = ('dep', 'configuration')
+
     dep: DDSDependency
     configuration: Dict[str, str]
 
@@ -193,7 +216,7 @@ class MetaPackageInfo:
         meta_depends: List[Union[str, MetaDependency.JSON]]
 
     pkg_id: PackageID
-    version: VersionInfo
+    version: 'VersionInfo'
     find_package_map: FindPackageMap
     depends: List[DDSDependency] = field(default_factory=list)
     meta_depends: List[MetaDependency] = field(default_factory=list)
@@ -202,14 +225,15 @@ class MetaPackageInfo:
     def parse(json: JSON) -> 'MetaPackageInfo':
         return MetaPackageInfo(
             pkg_id=PackageID(json['namespace'], json['name']),
-            version=VersionInfo.parse(json['version']),
+            version=_parse_version(json['version']),
             find_package_map=FindPackageMap.parse(
                 find_package_name=json.get('find_package', json['name']),
                 library_map=json.get(
                     'library_map', {json['name']: f"{json['namespace']}::{json['name']}"})
             ),
-            depends=json.get('depends', []),
-            meta_depends=json.get('meta_depends', []),
+            # Copied: `json` may be shared (see _load_json5_file)
+            depends=list(json.get('depends', [])),
+            meta_depends=list(json.get('meta_depends', [])),
         )
 
     def to_json(self) -> JSON:
@@ -227,6 +251,34 @@ class MetaPackageInfo:
         )
 
 
+def _project_files(project: Path) -> Set[str]:
+    '''
+    The names of the regular files directly within `project`. One directory
+    scan is cheaper than a stat per file we look for.
+    '''
+    try:
+        with os.scandir(project) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def _load_json5(path: Path):
+    stat = os.stat(path)
+    return _load_json5_file(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_json5_file(path: str, mtime_ns: int, size: int):
+    '''
+    Parse a package file. The modification time and size are part of the
+    cache key so that edits to the file are picked up. The result is shared;
+    do not modify it.
+    '''
+    with open(path, 'rb') as f:
+        return jsonutils.loads_json5(f.read())
+
+
 @dataclass
 class MetaPackage(ABC):
     info: MetaPackageInfo
@@ -243,17 +295,23 @@ class MetaPackage(ABC):
         return []
 
     @staticmethod
-    def load(project: Path, options: 'MetaPackageCMake.Options' = None) -> 'MetaPackage':
-        if project.joinpath('meta_package.json5').is_file():
-            return MetaPackageDDS.parse(json5.loads(project.joinpath('meta_package.json5').read_text()))
-        elif project.joinpath('CMakeLists.txt').is_file():
-            # TODO: Should this have its own build_dir too?
-            cmake_exe = dataclasses.replace(exes.cmake, source_dir=project)
-
-            if project.joinpath('meta_package.info.json5').is_file():
+    def load(project: Path, options: 'MetaPackageCMake.Options' = None,
+             build_dir: Optional[Path] = None) -> 'MetaPackage':
+        '''
+        :param build_dir: The CMake build directory to use, if CMake is needed.
+            Default: the build directory of `exes.cmake`.
+        '''
+        project_files = _project_files(project)
+        if 'meta_package.json5' in project_files:
+            return MetaPackageDDS.parse(_load_json5(project / 'meta_package.json5'))
+        elif 'CMakeLists.txt' in project_files:
+            cmake_exe = dataclasses.replace(
+                exes.cmake, source_dir=project, build_dir=build_dir or exes.cmake.build_dir)
+
+            if 'meta_package.info.json5' in project_files:
                 return MetaPackageCMake(
-                    info=MetaPackageInfo.parse(json5.loads(
-                        project.joinpath('meta_package.info.json5').read_text())),
+                    info=MetaPackageInfo.parse(
+                        _load_json5(project / 'meta_package.info.json5')),
                     cmake_exe=cmake_exe,
                 )
 
@@ -365,22 +423,26 @@ class MetaPackageCMake(MetaPackage):
 
     # Overrides to give a meta_package.info.json5 so that we don't have to re-infer.
     def psuedofiles(self) -> Iterable[Tuple[str, str]]:
-        yield ('meta_package.info.json5', json.dumps(self.info.to_json(), indent=2))
+        # Only ever read back by meta-dds, so there's no need to pretty print it.
+        yield ('meta_package.info.json5', jsonutils.dumps(self.info.to_json()))
 
     @dataclass
     class Options:
         name: Optional[str] = None
         namespace: Optional[str] = None
-        version: Optional[VersionInfo] = None
+        version: Optional['VersionInfo'] = None
         find_package_map: Optional[FindPackageMap] = None
         depends: Optional[List[DDSDependency]] = None
         meta_depends: Optional[List[MetaDependency]] = None
 
     @staticmethod
-    def load(cmake_exe: CMake, options: Options) -> 'MetaPackageCMake':
+    def load(cmake_exe: CMake, options: Options, codemodel: Optional[dict] = None) -> 'MetaPackageCMake':
+        '''
+        Pass `codemodel` if the caller has already queried it, to save querying again.
+        '''
         if options.name is None:
-            file_api = CMakeFileApiV1(cmake_exe, 'meta-dds')
-            codemodel, = file_api.query(FileApiQuery.CODEMODEL_V2)
+            if codemodel is None:
+                codemodel = CMakeFileApiV1(cmake_exe, 'meta-dds').cached_codemodel()
             options.name = codemodel['configurations'][0]['projects'][0]['name']
             _logger.info('Inferred package name as %s', options.name)
 
@@ -397,13 +459,14 @@ class MetaPackageCMake(MetaPackage):
                         'version', 'No CMakeCache.txt generated', '--pkg-version',
                         project=cmake_exe.source_dir)
 
-            m = re.search(r'^CMAKE_PROJECT_VERSION:STATIC=(.*)$',
-                          cmakecache.read_text(), flags=re.MULTILINE)
+            # CMakeCache.txt can be large; stop reading at the first match.
+            with open(cmakecache, 'rb') as f:
+                m = next(filter(None, map(_PROJECT_VERSION_RE.match, f)), None)
             if not m:
                 raise CannotInferPackageInfo.of(
                     'version', 'No VERSION in project() command', '--pkg-version',
                     project=cmake_exe.source_dir)
-            options.version = VersionInfo.parse(m.group(1))
+            options.version = _parse_version(m.group(1).decode('utf-8'))
             _logger.info('Inferred package version as %s', options.version)
 
         if options.find_package_map is None:
@@ -5,6 +5,7 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 import logging
+import os
 import sys
 from abc import ABC, abstractmethod, abstractmethod
 from dataclasses import dataclass
@@ -19,6 +20,12 @@ _logger = logging.getLogger(__name__)
 Dirs & logic ported from DDS proper
 '''
 
+
+def _abspath(path) -> Path:
+    # Unlike Path.resolve(), this doesn't stat every path component.
+    return Path(os.path.abspath(path))
+
+
 class _Paths(ABC):
     @abstractmethod
     def user_home_dir(self) -> Path:
@@ -48,16 +55,16 @@ class _Paths(ABC):
 
 class _WindowsPaths(_Paths):
     def user_home_dir(self) -> Path:
-        return Path(getenv('UserProfile', '/')).resolve()
+        return _abspath(getenv('UserProfile', '/'))
 
     def user_data_dir(self) -> Path:
-        return Path(getenv('LocalAppData', '/')).resolve()
+        return _abspath(getenv('LocalAppData', '/'))
 
     def user_cache_dir(self) -> Path:
-        return Path(getenv('LocalAppData', '/')).resolve()
+        return _abspath(getenv('LocalAppData', '/'))
 
     def user_config_dir(self) -> Path:
-        return Path(getenv('AppData', '/')).resolve()
+        return _abspath(getenv('AppData', '/'))
 
 
 @dataclass
@@ -69,18 +76,18 @@ class _UnixPaths(_Paths):
     def user_home_dir(self) -> Path:
         home = getenv('HOME')
         if home is not None:
-            return Path(home).resolve()
+            return _abspath(home)
         _logger.error('No HOME environment variable set!')
         return Path('/')
 
     def user_data_dir(self) -> Path:
-        return Path(getenv('XDG_DATA_HOME', self.user_home_dir() / self.data)).resolve()
+        return _abspath(getenv('XDG_DATA_HOME', self.user_home_dir() / self.data))
 
     def user_cache_dir(self) -> Path:
-        return Path(getenv('XDG_CACHE_HOME', self.user_home_dir() / self.cache)).resolve()
+        return _abspath(getenv('XDG_CACHE_HOME', self.user_home_dir() / self.cache))
 
     def user_config_dir(self) -> Path:
-        return Path(getenv('XDG_CONFIG_HOME', self.user_home_dir() / self.config)).resolve()
+        return _abspath(getenv('XDG_CONFIG_HOME', self.user_home_dir() / self.config))
 
 
 if sys.platform.startswith('win32'):
@@ -101,4 +108,12 @@ else:
     _logger.critical('Unsupported platform %s', sys.platform())
     exit(logutils.EXIT_INTERNAL_ERROR)
 
-sys.modules[__name__] = _PATHS
+
+def __getattr__(name: str):
+    '''
+    Expose the platform's paths as this module's functions (e.g.
+    `paths.dds_config_dir()`).
+    '''
+    if name.startswith('_') or not hasattr(_PATHS, name):
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(_PATHS, name)
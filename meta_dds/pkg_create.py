@@ -5,58 +5,94 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 import argparse
+import contextlib
+import functools
+import io
+import os
+import shutil
+import subprocess
+import time
 from pathlib import Path
 from tarfile import TarFile, TarInfo
-from tempfile import NamedTemporaryFile
-from typing import Callable, List, Optional
-
-import pathspec
-from semver import VersionInfo
+from typing import Iterator, Optional, Sequence
 
 from meta_dds import cli
-from meta_dds.package import (DDSDependency, FindPackageMap, Lib,
-                              MetaDependency, MetaPackage, MetaPackageCMake)
+from meta_dds.package import MetaPackage, MetaPackageCMake
+
+
+_BUFSIZE = 1 << 20
+
+
+@contextlib.contextmanager
+def _open_tgz(output: Path) -> Iterator[TarFile]:
+    '''
+    Open `output` for writing as a .tar.gz. Compression dominates for larger
+    projects, so when pigz is installed, use it to compress on every core.
+    '''
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        # Stream mode writes in large blocks rather than tar's 10 KiB records.
+        # The name lets tar.add() skip the archive itself if it's inside the project.
+        with open(output, 'wb', buffering=_BUFSIZE) as out, \
+                TarFile.open(str(output), mode='w|gz', fileobj=out, bufsize=_BUFSIZE) as tar:
+            yield tar
+        return
+
+    with open(output, 'wb') as out:
+        proc = subprocess.Popen([pigz, '-p', str(os.cpu_count() or 1), '-c'],
+                                stdin=subprocess.PIPE, stdout=out, bufsize=_BUFSIZE)
+        try:
+            with TarFile.open(str(output), mode='w|', fileobj=proc.stdin, bufsize=_BUFSIZE) as tar:
+                yield tar
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_gitignore(gitignore: str, mtime_ns: int, size: int):
+    '''
+    Compile a .gitignore. The modification time and size are part of the cache
+    key so that edits to the file are picked up.
+    '''
+    import pathspec
+
+    with open(gitignore, 'r') as f:
+        return pathspec.PathSpec.from_lines('gitwildmatch', f.read().splitlines())
 
 
 def pkg_create(project: Path, output: Optional[Path], options: Optional[MetaPackageCMake.Options] = None):
     pkg = MetaPackage.load(project, options)
     if output is None:
         output = Path(f'{pkg.info.pkg_id.name}@{pkg.info.version}.tar.gz')
-    if project.joinpath('.gitignore').is_file():
-        spec = pathspec.PathSpec.from_lines(
-            'gitwildmatch', project.joinpath('.gitignore').read_text().splitlines())
-
-        def additional_filter(info: TarInfo) -> TarInfo:
-            if spec.match_file(info.name):
-                return None
-            return info
+    gitignore = project / '.gitignore'
+    if gitignore.is_file():
+        stat = gitignore.stat()
+        is_ignored = _load_gitignore(str(gitignore), stat.st_mtime_ns, stat.st_size).match_file
     else:
-        def additional_filter(info: TarInfo) -> TarInfo: return info
-
-    with TarFile.open(output, 'w:gz') as tar:
-        def simple_filter(info: TarInfo) -> TarInfo:
-            if info.name in ('.git',):
-                return None
-            return info
-
-        def multi_filter(*filters: List[Callable[[TarInfo], TarInfo]]) -> Callable[[TarInfo], TarInfo]:
-            def f(info: TarInfo) -> TarInfo:
-                for filter in filters:
-                    info = filter(info)
-                    if info is None:
-                        return None
-                return info
-            return f
-
-        tar.add(project, arcname='', filter=multi_filter(
-            simple_filter, additional_filter))
+        is_ignored = None
+
+    # Called for every file in the project; keep it to a single function.
+    def tar_filter(info: TarInfo) -> Optional[TarInfo]:
+        name = info.name
+        if name == '.git' or (is_ignored is not None and is_ignored(name)):
+            return None
+        return info
+
+    with _open_tgz(output) as tar:
+        tar.add(project, arcname='', filter=tar_filter)
 
+        now = time.time()
         for (filename, memfile) in pkg.psuedofiles():
-            with NamedTemporaryFile(prefix='meta-dds-tar-mem-') as f:
-                f.write(memfile.encode('utf-8'))
-                f.flush()
-                f.seek(0)
-                tar.add(f.name, filename, recursive=False)
+            # Add straight from memory, rather than round tripping through a temporary file.
+            data = memfile.encode('utf-8')
+            info = TarInfo(filename)
+            info.size = len(data)
+            info.mtime = now
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
 
 
 def pkg_create_main(args: argparse.Namespace):
@@ -66,7 +102,7 @@ def pkg_create_main(args: argparse.Namespace):
         options=cli.parse_cmake_meta_info(args))
 
 
-def setup_parser(parser: argparse.ArgumentParser):
+def setup_parser(parser: argparse.ArgumentParser, argv: Sequence[str] = ()):
     cli.add_arguments(parser, cli.project)
     parser.add_argument('-o', '--out', '--output', type=Path, default=None,
                         dest='output',
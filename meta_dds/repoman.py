@@ -5,23 +5,25 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 import logging
+import os
+import secrets
 import shutil
 import sqlite3
+import stat
 import tarfile
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
-from random import getrandbits
-from tempfile import TemporaryDirectory
 from textwrap import dedent
-from typing import Iterable, List, Optional, Tuple
+from typing import Iterable, List, Optional, Sequence, Tuple
 
-import json5
 from semver import VersionInfo
 
-from meta_dds import cli, logutils
+from meta_dds import cli, jsonutils, logutils
 from meta_dds.errors import FileNotFound, MetaDDSException
-from meta_dds.package import MetaPackage, MetaPackageInfo, PackageID
+from meta_dds.package import MetaPackage, MetaPackageInfo
+from meta_dds.tempfiles import TemporaryDirectory
 from meta_dds.util import IfExists
 
 _logger = logging.getLogger(__name__)
@@ -52,9 +54,8 @@ class TGZHasEscapingFiles(BadSDistTGZ):
         return TGZHasEscapingFiles(f'{message}: [{escapes_str}]', escapes)
 
 
-def _init_db(cur: sqlite3.Cursor, name: str):
-    # Table schemas copied from DDS proper
-    cur.execute(dedent('''\
+# Table schemas copied from DDS proper
+_SCHEMA = dedent('''\
     CREATE TABLE IF NOT EXISTS meta_dds_repo_packages (
         package_id INTEGER PRIMARY KEY,
         name TEXT NOT NULL,
@@ -63,9 +64,7 @@ def _init_db(cur: sqlite3.Cursor, name: str):
         url TEXT NOT NULL,
         UNIQUE (name, version)
     );
-    '''))
 
-    cur.execute(dedent('''\
     CREATE TABLE IF NOT EXISTS meta_dds_repo_package_deps (
         dep_id INTEGER PRIMARY KEY,
         package_id INTEGER NOT NULL
@@ -76,9 +75,7 @@ def _init_db(cur: sqlite3.Cursor, name: str):
         high TEXT NOT NULL,
         UNIQUE(package_id, dep_name)
     );
-    '''))
 
-    cur.execute(dedent('''\
     CREATE TABLE IF NOT EXISTS meta_dds_repo_package_meta_deps (
         dep_id INTEGER PRIMARY KEY,
         package_id INTEGER NOT NULL
@@ -89,27 +86,48 @@ def _init_db(cur: sqlite3.Cursor, name: str):
         high TEXT NOT NULL,
         UNIQUE(package_id, dep_name)
     );
-    '''))
 
-    cur.execute(dedent('''\
     CREATE TABLE IF NOT EXISTS meta_dds_repo_meta (
         meta_version INTEGER DEFAULT 1,
         version INTEGER NOT NULL,
         name TEXT NOT NULL
     );
-    '''))
-
-    cur.execute(dedent('''\
+    ''')
+_INSERT_META = dedent('''\
     INSERT INTO meta_dds_repo_meta (version, name)
         VALUES (0, ?);
-    '''), (name,))
+    ''')
+
+
+def _init_db(cur: sqlite3.Cursor, name: str):
+    # As one script, sqlite parses all of the tables in a single call.
+    cur.executescript(_SCHEMA)
+    cur.execute(_INSERT_META, (name,))
+
+
+# Built once, so that each call hands sqlite the same text (and hits its statement cache).
+# sqlite formats each `name@version' itself.
+_SELECT_PACKAGE_IDS = "SELECT name || '@' || version FROM meta_dds_repo_packages"
+_INSERT_PACKAGE = dedent('''\
+    INSERT INTO meta_dds_repo_packages (name, version, description, url)
+        VALUES (?, ?, ?, ?);
+    ''')
+_DELETE_PACKAGE = dedent('''\
+    DELETE FROM meta_dds_repo_packages
+        WHERE name = (?)
+          AND version = (?);
+    ''')
+
+
+# The files in a meta-sdist which say what package it is
+_PACKAGE_FILES = frozenset({'meta_package.json5', 'meta_package.info.json5', 'CMakeLists.txt'})
 
 
 @dataclass
 class Repoman:
     repo: Path
     name: Optional[str] = None
-    __con: sqlite3.Connection = field(init=False)
+    __con: Optional[sqlite3.Connection] = field(default=None, init=False)
 
     @property
     def pkg_dir(self):
@@ -121,27 +139,40 @@ class Repoman:
 
     @property
     def repo_db_gz(self):
-        return self.repo_db + '.gz'
+        return Path(os.fspath(self.repo_db) + '.gz')
 
     def __post_init__(self):
-        if not self.repo.is_dir():
+        try:
+            is_dir = stat.S_ISDIR(os.stat(self.repo).st_mode)
+        except OSError:
+            is_dir = False
+        if not is_dir:
             raise RepomanError.format('Repo is not yet initialized', self.repo)
-        self.__con = sqlite3.connect(self.repo_db)
+
+    @property
+    def _con(self) -> sqlite3.Connection:
+        # Connect on first use; not everything done with a Repoman touches the database.
+        if self.__con is None:
+            self.__con = sqlite3.connect(self.repo_db)
+        return self.__con
 
     def repo_pkg_dir(self, name: str, version: VersionInfo) -> Path:
         return self.pkg_dir / name / str(version)
 
     def commit(self):
-        self.__con.commit()
+        if self.__con is not None:
+            self.__con.commit()
 
     def close(self):
-        self.__con.close()
+        if self.__con is not None:
+            self.__con.close()
+            self.__con = None
 
     def init(self):
         '''
         Initialize the repo database.
         '''
-        cur = self.__con.cursor()
+        cur = self._con.cursor()
         try:
             _init_db(cur, self.name)
         finally:
@@ -151,89 +182,97 @@ class Repoman:
         '''
         List the repo contents
         '''
-        cur = self.__con.cursor()
-        try:
-            cur.execute('SELECT name, version FROM meta_dds_repo_packages')
-            repos = cur.fetchall()
-        finally:
-            cur.close()
-
-        return [f'{name}@{ver}' for name, ver in repos]
+        return [pkg_id for pkg_id, in self._con.execute(_SELECT_PACKAGE_IDS)]
 
     def add(self, name: str, version: VersionInfo, description: str, url: str, additional_files: Iterable[Tuple[Path, Path]] = []):
-        cur = self.__con.cursor()
-        try:
-            cur.execute(dedent('''\
-                INSERT INTO meta_dds_repo_packages (name, version, description, url)
-                    VALUES (?, ?, ?, ?);
-                '''), (name, str(version), description, url))
-        finally:
-            cur.close()
+        self._con.execute(_INSERT_PACKAGE, (name, str(version), description, url))
 
         dest_dir = self.repo_pkg_dir(name, version)
         stamp_path = dest_dir / 'url.txt'
         dest_dir.mkdir(parents=True)
         stamp_path.write_text(url)
 
-        for dst_file, file in additional_files:
-            dst_path = dest_dir / dst_file
-            assert dest_dir in dst_path.parents
-            shutil.copy(file, dst_path)
+        files = [(file, dest_dir / dst_file) for dst_file, file in additional_files]
+        for dst_dir in {dst_path.parent for _, dst_path in files}:
+            assert dst_dir == dest_dir or dest_dir in dst_dir.parents
+            dst_dir.mkdir(parents=True, exist_ok=True)
+
+        for file, dst_path in files:
+            # Not hard linked: the source is the user's file, and may be overwritten in place.
+            shutil.copyfile(file, dst_path)
+
+    def import_(self, meta_sdist_tgz: Path, tmp_dir: Optional[Path] = None):
+        self._add_sdist(meta_sdist_tgz, self._load_sdist(meta_sdist_tgz, tmp_dir))
+
+    def _load_sdist(self, meta_sdist_tgz: Path, tmp_dir: Optional[Path] = None) -> MetaPackageInfo:
+        '''
+        Read the package info out of a meta-sdist. This doesn't touch the repository,
+        so several sdists can be loaded at once.
 
-    def import_(self, meta_sdist_tgz: Path):
-        if not meta_sdist_tgz.is_file():
-            if meta_sdist_tgz.exists():
-                raise FileNotFound(
-                    f'Not a valid sdist file (must be a .tar.gz file): {meta_sdist_tgz}', meta_sdist_tgz)
+        :param tmp_dir: Where to extract the sdist, if it needs extracting. If
+            not given, a temporary directory is used.
+        '''
+        # One stat tells apart both failures.
+        try:
+            st = os.stat(meta_sdist_tgz)
+        except FileNotFoundError:
+            raise FileNotFound(
+                f'File does not exist: {meta_sdist_tgz}', meta_sdist_tgz) from None
+        if not stat.S_ISREG(st.st_mode):
             raise FileNotFound(
-                f'File does not exist: {meta_sdist_tgz}', meta_sdist_tgz)
+                f'Not a valid sdist file (must be a .tar.gz file): {meta_sdist_tgz}', meta_sdist_tgz)
 
         with tarfile.open(meta_sdist_tgz, mode='r:gz') as tar:
-            names = tar.getnames()
-            bad_files = [name for name in names
-                         if self.pkg_dir not in self.pkg_dir.joinpath(name).parents and name]
+            members = tar.getmembers()
+            # Plain string operations; building a Path and its parents per member is slow for large sdists.
+            pkg_root = os.path.join(os.path.normpath(self.pkg_dir), '')
+            bad_files = []
+            # MetaPackage.load only reads these, unless it has to infer the
+            # package info by running CMake over the whole tree.
+            package_files = {}
+            # One pass over the members does both the escape check and finds the package files.
+            for member in members:
+                name = member.name
+                if name and not os.path.normpath(os.path.join(pkg_root, name)).startswith(pkg_root):
+                    bad_files.append(name)
+                elif name in _PACKAGE_FILES and member.isfile():
+                    # Later members overwrite earlier ones when extracted, so keep the last.
+                    package_files[name] = member
             if bad_files:
                 raise TGZHasEscapingFiles.format(
                     f"Files escape from `{meta_sdist_tgz}'", bad_files)
 
-            with TemporaryDirectory(prefix='meta-dds-sdist-') as tmp:
-                tmp = Path(tmp)
-                tar.extractall(tmp)
-
-                if tmp.joinpath('meta_package.info.json5').is_file():
-                    _logger.info(
-                        'Found meta_package.info.json5 for %s', meta_sdist_tgz)
-                    meta_info = json5.loads(tmp.joinpath(
-                        'meta_package.info.json5').read_text())
-
-                    info = MetaPackageInfo(
-                        PackageID(
-                            namespace=meta_info['namespace'], name=meta_info['name']),
-                        version=VersionInfo.parse(meta_info['version']),
-                    )
-                    _logger.info("Loaded meta-package info: %s/%s @ %s",
-                                 info.pkg_id.namespace, info.pkg_id.name, info.version)
-                else:
-                    info = None
-
-                pkg: MetaPackage = MetaPackage.load(tmp, info)
-
-                self.add(pkg.info.pkg_id.name, pkg.info.version, '[no description]',
-                         f'dds:{pkg.info.pkg_id.name}@{pkg.info.version}',
-                         additional_files=[
-                             ('sdist.tar.gz', meta_sdist_tgz)
-                         ])
+            # Same precedence as MetaPackage.load: meta_package.json5 wins, and
+            # meta_package.info.json5 only describes a CMake project.
+            info_member = package_files.get('meta_package.info.json5')
+            if (info_member is not None and 'meta_package.json5' not in package_files
+                    and 'CMakeLists.txt' in package_files):
+                _logger.info(
+                    'Found meta_package.info.json5 for %s', meta_sdist_tgz)
+                # It holds the full package info, so there's nothing to extract or load.
+                info = MetaPackageInfo.parse(jsonutils.loads_json5(
+                    tar.extractfile(info_member).read()))
+                _logger.info("Loaded meta-package info: %s/%s @ %s",
+                             info.pkg_id.namespace, info.pkg_id.name, info.version)
+                return info
+
+            with TemporaryDirectory(scratch_dir=tmp_dir, prefix='meta-dds-sdist-') as tmp:
+                tar.extractall(tmp, members=package_files.values())
+                if 'meta_package.json5' not in package_files:
+                    tar.extractall(tmp)
+
+                # Sdists may be loaded concurrently, so CMake can't share exes.cmake's build directory.
+                return MetaPackage.load(tmp, build_dir=tmp / '_cmake_build').info
+
+    def _add_sdist(self, meta_sdist_tgz: Path, info: MetaPackageInfo):
+        self.add(info.pkg_id.name, info.version, '[no description]',
+                 f'dds:{info.pkg_id.name}@{info.version}',
+                 additional_files=[
+                     ('sdist.tar.gz', meta_sdist_tgz)
+                 ])
 
     def remove(self, name: str, version: VersionInfo):
-        cur = self.__con.cursor()
-        try:
-            cur.execute(dedent('''\
-                DELETE FROM meta_dds_repo_packages
-                    WHERE name = (?)
-                      AND version = (?);
-                '''), (name, str(version)))
-        finally:
-            cur.close()
+        self._con.execute(_DELETE_PACKAGE, (name, str(version)))
 
         shutil.rmtree(self.repo_pkg_dir(name, version))
 
@@ -253,10 +292,8 @@ def get_dds_repo_name(dds_exe: Path, repo: Path) -> Optional[str]:
 
 
 def _rand_hex(num) -> str:
-    HEX_BITS = 4
-    randbits = getrandbits(HEX_BITS * num)
-    # Format as hex, with leading 0s and `num` positions
-    return f'{randbits:0{num}x}'
+    # Two hex digits per byte
+    return secrets.token_hex((num + 1) // 2)[:num]
 
 
 def generate_repo_name() -> str:
@@ -281,7 +318,8 @@ def init_main(args: Namespace):
             exit(logutils.EXIT_INTERNAL_ERROR)
 
     args.repo_dir.mkdir()
-    repoman = Repoman(args.repo_dir, args.name)
+    # Only generated here, so that other commands don't pay for it.
+    repoman = Repoman(args.repo_dir, args.name or generate_repo_name())
     repoman.init()
     repoman.commit()
     repoman.close()
@@ -299,8 +337,16 @@ def add_main(args: Namespace):
 
 def import_main(args: Namespace):
     repoman = Repoman(args.repo_dir)
-    for meta_sdist_tgz in args.meta_sdist_file_path:
-        repoman.import_(meta_sdist_tgz)
+    meta_sdist_tgzs = args.meta_sdist_file_path
+    # Loading an sdist is mostly decompression, which zlib does outside the GIL.
+    # Everything is loaded before anything is added, so a bad sdist leaves the repo untouched.
+    # One temporary directory for the lot, rather than one per sdist.
+    with TemporaryDirectory(prefix='meta-dds-sdist-') as tmp_root, \
+            ThreadPoolExecutor(max_workers=min(len(meta_sdist_tgzs), os.cpu_count() or 1)) as pool:
+        infos = list(pool.map(repoman._load_sdist, meta_sdist_tgzs,
+                              [tmp_root / f'sdist{i}' for i in range(len(meta_sdist_tgzs))]))
+    for meta_sdist_tgz, info in zip(meta_sdist_tgzs, infos):
+        repoman._add_sdist(meta_sdist_tgz, info)
         _logger.info('Imported %s', meta_sdist_tgz)
 
     repoman.commit()
@@ -317,7 +363,7 @@ def remove_main(args: Namespace):
     repoman.close()
 
 
-def setup_parser(parser: ArgumentParser):
+def setup_parser(parser: ArgumentParser, argv: Sequence[str] = ()):
     repoman = parser.add_subparsers()
 
     def repo_dir(parser: ArgumentParser):
@@ -329,7 +375,7 @@ def setup_parser(parser: ArgumentParser):
     cli.if_exists(
         init, help='What to do if the directory exists and is already a repository.')
     init.add_argument(
-        '-n', '--name', default=generate_repo_name(), help='Specify the name of the new repository. Default: a generated name.')
+        '-n', '--name', default=None, help='Specify the name of the new repository. Default: a generated name.')
     repo_dir(init)
     init.set_defaults(func=init_main)
 
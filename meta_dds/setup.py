@@ -8,7 +8,7 @@ import argparse
 from argparse import ArgumentParser
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from typing import List, Sequence
 
 from meta_dds import cli
 from meta_dds.sdist import SDistTemplate, ToolchainSpecificSDist, PureSDist
@@ -39,6 +39,6 @@ def build_setup_main(args: argparse.Namespace):
     setup.setup()
 
 
-def setup_parser(parser: ArgumentParser):
+def setup_parser(parser: ArgumentParser, argv: Sequence[str] = ()):
     cli.add_arguments(parser, cli.project, cli.toolchain, cli.output)
     parser.set_defaults(func=build_setup_main)
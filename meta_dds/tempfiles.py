@@ -8,25 +8,27 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 Internal utilities for working with tempfiles.
 '''
 
+import os
 import shutil
 import tempfile
 from pathlib import Path
 from contextlib import contextmanager
 
 @contextmanager
-def TemporaryDirectory(scratch_dir=None, **kwargs):
+def TemporaryDirectory(scratch_dir=None, clean=False, **kwargs):
     '''
     Create a temporary directory.
     
     :param scratch_dir: If specified, this directory is used instead of a
-        temporary directory. The directory will *not* be removed when finished;
-        instead, it will be removed upfront if it exists.
+        temporary directory. The directory will *not* be removed when finished,
+        and any existing contents are kept so that they can be reused.
+    :param clean: If set, an existing `scratch_dir` is removed upfront.
     '''
     if scratch_dir is not None:
         scratch_dir = Path(scratch_dir)
-        if scratch_dir.exists():
+        if clean and scratch_dir.exists():
             shutil.rmtree(scratch_dir)
-        scratch_dir.mkdir(parents=True)
+        scratch_dir.mkdir(parents=True, exist_ok=True)
         
         yield scratch_dir
     else:
@@ -35,3 +37,24 @@ def TemporaryDirectory(scratch_dir=None, **kwargs):
         with tempfile.TemporaryDirectory(**kwargs) as f:
             yield Path(f)
 
+
+# Read once at import; os.umask can only be read by setting it, which races with other threads.
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def write_text_atomic(path: Path, contents: str):
+    '''
+    Write `contents` to `path` via a temporary file which is then renamed over
+    `path`, so that readers never see a partially written file.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        # mkstemp creates the file as 0600; give it the mode a plain write would have.
+        os.chmod(tmp, 0o666 & ~_UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
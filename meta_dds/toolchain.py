@@ -5,15 +5,17 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 
+import functools
+import io
 import logging
+import os
 import re
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable, Optional
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, Mapping, Optional, Type
 
-import json5
-
-from meta_dds import paths
+from meta_dds import jsonutils, paths
 from meta_dds.logutils import EXIT_USER_ERROR
 
 DDSToolchain = dict
@@ -21,76 +23,107 @@ DDSToolchain = dict
 _logger = logging.getLogger(__name__)
 
 
-def _default_dds_toolchain_paths() -> Iterable[Path]:
+# In order of preference
+_TOOLCHAIN_FILE_NAMES = ('toolchain.json5', 'toolchain.jsonc', 'toolchain.json')
+
+
+def _default_dds_toolchain_dirs() -> Iterable[Path]:
     return (
-        Path.cwd() / 'toolchain.json5',
-        Path.cwd() / 'toolchain.jsonc',
-        Path.cwd() / 'toolchain.json',
-        paths.dds_config_dir() / 'toolchain.json5',
-        paths.dds_config_dir() / 'toolchain.jsonc',
-        paths.dds_config_dir() / 'toolchain.json',
-        paths.user_home_dir() / 'toolchain.json5',
-        paths.user_home_dir() / 'toolchain.jsonc',
-        paths.user_home_dir() / 'toolchain.json',
+        Path.cwd(),
+        paths.dds_config_dir(),
+        paths.user_home_dir(),
     )
 
 
+def _find_default_dds_toolchain() -> Optional[Path]:
+    # Listing each directory once finds any of the candidate names, rather
+    # than stat'ing every name in every directory.
+    for tc_dir in _default_dds_toolchain_dirs():
+        try:
+            with os.scandir(tc_dir) as entries:
+                found = {entry.name: entry for entry in entries
+                         if entry.name in _TOOLCHAIN_FILE_NAMES}
+        except OSError:
+            continue
+        for name in _TOOLCHAIN_FILE_NAMES:
+            entry = found.get(name)
+            if entry is not None and entry.is_file():
+                return tc_dir / name
+
+    return None
+
+
 def get_default_dds_toolchain() -> DDSToolchain:
-    for tc in _default_dds_toolchain_paths():
-        if tc.is_file():
-            _logger.trace('Found default toolchain: %s', tc)
-            return json5.loads(tc.read_text())
+    tc = _find_default_dds_toolchain()
+    if tc is not None:
+        _logger.trace('Found default toolchain: %s', tc)
+        stat = tc.stat()
+        return _load_dds_toolchain_file(str(tc), stat.st_mtime_ns, stat.st_size)
 
     _logger.error("Unable to find a default toolchain. " +
                   "Either specify a toolchain or provide a ``default toolchain''")
     exit(EXIT_USER_ERROR)
 
 
+_CPP_VERSIONS = frozenset(('98', '03', '11', '14', '17', '20', '23'))
+
+
 def get_builtin_toolchain(toolchain: str) -> DDSToolchain:
     '''
     Parse the builtin toolchain `toolchain`
 
     Ported from the DDS-proper `toolchain::get_builtin()` function
     '''
+    # Copied, so that callers can't modify the cached toolchain.
+    return dict(_get_builtin_toolchain(toolchain))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_builtin_toolchain(toolchain: str) -> Mapping[str, Any]:
     assert toolchain[0] == ':'
-    toolchain = [toolchain[1:]]
+    # Prefixes are matched in place at this index rather than sliced off.
+    i = 1
 
     result = {}
 
-    def get_prefix(prefix: str, default=None):
-        if toolchain[0].startswith(prefix):
-            toolchain[0] = toolchain[0][len(prefix):]
-            return prefix
+    def get_prefix(prefix: str) -> bool:
+        nonlocal i
+        if toolchain.startswith(prefix, i):
+            i += len(prefix)
+            return True
 
-        return default
+        return False
 
-    result['debug'] = bool(get_prefix('debug:'))
+    result['debug'] = get_prefix('debug:')
 
     def handle_prefix(key: str, prefix: str) -> bool:
-        if prefix_val := get_prefix(prefix):
-            result[key] = prefix_val[:-1]
+        if get_prefix(prefix):
+            result[key] = prefix[:-1]
+            return True
 
-        return bool(prefix_val)
+        return False
 
     handle_prefix('compiler_launcher', 'ccache:')
-    for cpp_ver in ('98', '03', '11', '14', '17', '20', '23'):
-        if handle_prefix('cxx_version', f'c++{cpp_ver}:'):
-            if cpp_ver == '23':
-                _logger.warn(
-                    'DDS does not support C++%s at this time', cpp_ver)
-            break
-
-    if toolchain[0].startswith('gcc') or toolchain[0].startswith('clang'):
-        is_gcc = bool(get_prefix('gcc'))
-        is_clang = bool(get_prefix('clang'))
+    # Every version is two digits, so look it up instead of trying each `c++XX:'.
+    cpp_ver = toolchain[i + 3:i + 5]
+    if toolchain.startswith('c++', i) and cpp_ver in _CPP_VERSIONS and toolchain.startswith(':', i + 5):
+        result['cxx_version'] = f'c++{cpp_ver}'
+        i += len('c++XX:')
+        if cpp_ver == '23':
+            _logger.warn(
+                'DDS does not support C++%s at this time', cpp_ver)
+
+    if toolchain.startswith(('gcc', 'clang'), i):
+        is_gcc = get_prefix('gcc')
+        is_clang = get_prefix('clang')
         assert is_gcc or is_clang
 
         c_compiler_base, cxx_compiler_base, compiler_id = ('gcc', 'g++', 'gnu') if is_gcc else (
             'clang', 'clang++', 'clang')
 
         if get_prefix('-'):
-            version = int(toolchain[0])
-            toolchain[0] = ''
+            version = int(toolchain[i:])
+            i = len(toolchain)
             if version not in (7, 8, 9, 10, 11, 12, 13):
                 _logger.warn(
                     'Compiler version may be unsupported for %s: %i', compiler_id, version)
@@ -102,24 +135,24 @@ def get_builtin_toolchain(toolchain: str) -> DDSToolchain:
         c_compiler_name = f'{c_compiler_base}{suffix}'
         cxx_compiler_name = f'{cxx_compiler_base}{suffix}'
 
-        if toolchain[0]:
+        if i < len(toolchain):
             _logger.error(
-                "Unknown remaining builtin toolchain suffix: `%s'", toolchain[0])
+                "Unknown remaining builtin toolchain suffix: `%s'", toolchain[i:])
             exit(EXIT_USER_ERROR)
 
         result['c_compiler'] = c_compiler_name
         result['cxx_compiler'] = cxx_compiler_name
         result['compiler_id'] = compiler_id
-    elif toolchain[0] == 'msvc':
+    elif toolchain[i:] == 'msvc':
         result['c_compiler'] = 'cl.exe'
         result['cxx_compiler'] = 'cl.exe'
         result['compiler_id'] = 'msvc'
     else:
         _logger.error(
-            "Unknown compiler in builtin toolchain: `%s'", toolchain[0])
+            "Unknown compiler in builtin toolchain: `%s'", toolchain[i:])
         exit(EXIT_USER_ERROR)
 
-    return result
+    return MappingProxyType(result)
 
 
 def get_dds_toolchain(dds_tcfile: Optional[str]) -> DDSToolchain:
@@ -127,20 +160,63 @@ def get_dds_toolchain(dds_tcfile: Optional[str]) -> DDSToolchain:
         return get_default_dds_toolchain()
     if dds_tcfile.startswith(':'):
         return get_builtin_toolchain(dds_tcfile)
-    with open(dds_tcfile, 'r') as f:
-        return json5.load(f)
+    stat = os.stat(dds_tcfile)
+    return _load_dds_toolchain_file(dds_tcfile, stat.st_mtime_ns, stat.st_size)
 
 
-def _removeprefix(s: str, prefix: str) -> str:
-    if s.startswith(prefix):
-        return s[len(prefix):]
-    else:
-        return s
+@functools.lru_cache(maxsize=32)
+def _load_dds_toolchain_file(dds_tcfile: str, mtime_ns: int, size: int) -> DDSToolchain:
+    '''
+    Parse a toolchain file. The modification time and size are part of the
+    cache key so that edits to the file are picked up. The result is shared;
+    do not modify it.
+    '''
+    with open(dds_tcfile, 'rb') as f:
+        data = f.read()
+    if dds_tcfile.endswith('.jsonc'):
+        return jsonutils.loads_jsonc(data)
+    return jsonutils.loads_json5(data)
+
+
+try:
+    _removeprefix = str.removeprefix
+except AttributeError:  # Python < 3.9
+    def _removeprefix(s: str, prefix: str) -> str:
+        if s.startswith(prefix):
+            return s[len(prefix):]
+        else:
+            return s
+
+
+_CACHE_SET = 'set({} "{}" CACHE {} "")\n'.format
+
+_DEFAULT_CXX_COMPILER = MappingProxyType({
+    'gnu': 'g++',
+    'clang': 'clang++',
+    'msvc': 'cl.exe',
+})
+_DEFAULT_C_COMPILER = MappingProxyType({
+    'gnu': 'gcc',
+    'clang': 'clang',
+    'msvc': 'cl.exe',
+})
+_GNU_LIKE = frozenset(('gnu', 'clang'))
+
+# Tokens in DDS command templates. Substituted in a single pass rather than one pass per token.
+_TEMPLATE_RE = re.compile(r'<compiler>|\[in\]|\[out\]|\[flags\]')
+_AR_TEMPLATE_RE = re.compile(r'\bar\b|\[in\]|\[out\]|\[flags\]')
+
+
+def _template_substituter(pattern: re.Pattern, table: Dict[str, str]) -> Callable[[str], str]:
+    def substitute(val: str) -> str:
+        return pattern.sub(lambda m: table[m.group(0)], val)
+
+    return substitute
 
 
 class ToolchainGenerator:
     def __init__(self, dds_toolchain: DDSToolchain):
-        self.result = []
+        self._buf = io.StringIO()
         self.dds_toolchain = dds_toolchain
 
     @property
@@ -149,19 +225,19 @@ class ToolchainGenerator:
 
     @property
     def is_gnu_like(self) -> bool:
-        return self.compiler_id in ('gnu', 'clang')
+        return self.compiler_id in _GNU_LIKE
 
     @property
     def is_msvc(self) -> bool:
         return self.compiler_id == 'msvc'
 
     def nl(self):
-        self.result.append('')  # we '\n'.join, so empty string = newline
+        self._buf.write('\n')
 
     def set(self, var: str, value):
         name, var_type = (var.split(':', maxsplit=1) + ['STRING'])[:2]
 
-        self.result.append(f'set({name} "{value}" CACHE {var_type} "")')
+        self._buf.write(_CACHE_SET(name, value, var_type))
 
     def __unwrap_list(self, val):
         if isinstance(val, list):
@@ -179,23 +255,12 @@ class ToolchainGenerator:
             self.set(var, fmt(*key_vals))
 
     def generate(self):
-        DEFAULT_CXX_COMPILER = {
-            'gnu': 'g++',
-            'clang': 'clang++',
-            'msvc': 'cl.exe',
-        }
-        DEFAULT_C_COMPILER = {
-            'gnu': 'gcc',
-            'clang': 'clang',
-            'msvc': 'cl.exe',
-        }
-
         dds_toolchain = self.dds_toolchain
 
         self.set('CMAKE_CXX_COMPILER:PATH', dds_toolchain.get(
-            'cxx_compiler', DEFAULT_CXX_COMPILER[self.compiler_id]))
+            'cxx_compiler', _DEFAULT_CXX_COMPILER[self.compiler_id]))
         self.set('CMAKE_C_COMPILER:PATH', dds_toolchain.get(
-            'c_compiler', DEFAULT_C_COMPILER[self.compiler_id]))
+            'c_compiler', _DEFAULT_C_COMPILER[self.compiler_id]))
 
         self.cset('CMAKE_CXX_STANDARD',
                   lambda std: _removeprefix(std, 'c++'), 'cxx_version')
@@ -209,7 +274,7 @@ class ToolchainGenerator:
         self.nl()
 
     def get(self) -> str:
-        return '\n'.join(self.result) + '\n'
+        return self._buf.getvalue()
 
 
 class ExtractSDistToolchainGenerator(ToolchainGenerator):
@@ -253,97 +318,132 @@ class FullCMakeCompileToolchainGenerator(ToolchainGenerator):
         self.cset('CMAKE_C_COMPILER_LAUNCHER:PATH', '{}', 'compiler_launcher')
         self.nl()
 
-        self.cset('CMAKE_CXX_STANDARD',
-                  lambda std: std.removeprefix('c++'), 'cxx_version')
-        self.cset('CMAKE_C_STANDARD',
-                  lambda std: std.removeprefix('c'), 'c_version')
-        self.set('CMAKE_CXX_EXTENSIONS:BOOL', str('gnu' in self.dds_toolchain.get(
-            'lang_version_flag_template', '')).upper() if self.is_gnu_like else 'FALSE')
-        self.nl()
-
-        self.set('CMAKE_POSITION_INDEPENDENT_CODE:BOOL', 'YES')
-        self.nl()
-
         self.set('CMAKE_BUILD_TYPE', 'MetaDDS')
 
-        self.set('CMAKE_CXX_FLAGS_METADDS',
-                 f'{self.dbg_flags()} {self.opt_flags()} {self.rt_flags()}')
-        self.set('CMAKE_C_FLAGS_METADDS',
-                 f'{self.dbg_flags()} {self.opt_flags()} {self.rt_flags()}')
+        # Shared by both languages
+        flags = f'{self.dbg_flags()} {self.opt_flags()} {self.rt_flags()}'
+        self.set('CMAKE_CXX_FLAGS_METADDS', flags)
+        self.set('CMAKE_C_FLAGS_METADDS', flags)
         self.set('CMAKE_EXE_LINKER_FLAGS_METADDS', f'')
         self.set('CMAKE_SHARED_LINKER_FLAGS_METADDS', f'')
         self.set('CMAKE_STATIC_LINKER_FLAGS_METADDS', f'')
 
     def link_exe_for(self, lang: str):
-        def f(val: str):
-            return (val.replace('<compiler>', f'<CMAKE_{lang}_COMPILER>')
-                    .replace('[in]', '<OBJECTS>')
-                    .replace('[out]', '<TARGET>')
-                    .replace('[flags]', f'<FLAGS> <CMAKE_{lang}_LINK_FLAGS> <LINK_FLAGS> <LINK_LIBRARIES>'))
-
-        return f
+        return _template_substituter(_TEMPLATE_RE, {
+            '<compiler>': f'<CMAKE_{lang}_COMPILER>',
+            '[in]': '<OBJECTS>',
+            '[out]': '<TARGET>',
+            '[flags]': f'<FLAGS> <CMAKE_{lang}_LINK_FLAGS> <LINK_FLAGS> <LINK_LIBRARIES>',
+        })
 
     def create_ar_for(self, lang: str):
-        def f(val: str):
-            return (re.sub(r'\b(ar)\b', '<CMAKE_AR>', val)
-                    .replace('[in]', '<OBJECTS>')
-                    .replace('[out]', '<TARGET>')
-                    .replace('[flags]', f'<LINK_FLAGS>'))
-
-        return f
+        return _template_substituter(_AR_TEMPLATE_RE, {
+            'ar': '<CMAKE_AR>',
+            '[in]': '<OBJECTS>',
+            '[out]': '<TARGET>',
+            '[flags]': '<LINK_FLAGS>',
+        })
 
     def compile_obj_for(self, lang: str):
-        def f(val: str):
-            return (val.replace('<compiler>', f'<CMAKE_{lang}_COMPILER>')
-                    .replace('[in]', '<SOURCE>')
-                    .replace('[out]', '<OBJECT>')
-                    .replace('[flags]', f'<DEFINES> <INCLUDES> <FLAGS>'))
+        return _template_substituter(_TEMPLATE_RE, {
+            '<compiler>': f'<CMAKE_{lang}_COMPILER>',
+            '[in]': '<SOURCE>',
+            '[out]': '<OBJECT>',
+            '[flags]': '<DEFINES> <INCLUDES> <FLAGS>',
+        })
+
+    # The flags default to GCC style, with no runtime flags; compilers which
+    # differ have their own subclasses, so each generator's flags don't branch
+    # on the compiler.
+    def dbg_flags(self):
+        if 'debug' not in self.dds_toolchain:
+            return ''
+
+        if self.dds_toolchain['debug'] == 'split':
+            return '-gsplit-dwarf'
+        elif self.dds_toolchain['debug'] == True or self.dds_toolchain['debug'] == 'embedded':
+            return '-g'
+        else:
+            return ''
+
+    def opt_flags(self):
+        if self.dds_toolchain.get('optimize', False):
+            return '-O2'
+        else:
+            return ''
+
+    def rt_flags(self):
+        return ''
+
+
+class GnuLikeFullCMakeCompileToolchainGenerator(FullCMakeCompileToolchainGenerator):
+    is_gnu_like = True
+    is_msvc = False
+
+    def rt_flags(self):
+        if 'runtime' not in self.dds_toolchain:
+            return ''
+
+        is_static = self.dds_toolchain['runtime'].get('static', False)
+        is_debug = self.dds_toolchain['runtime'].get('debug', False)
+
+        static = '-static-libgcc -static-libstdc++' if is_static else ''
+        debug = '-D_GLIBCXX_DEBUG -D_LIBCPP_DEBUG=1' if is_debug else ''
+        return f'{static} {debug}'
 
-        return f
+
+class MsvcFullCMakeCompileToolchainGenerator(FullCMakeCompileToolchainGenerator):
+    is_gnu_like = False
+    is_msvc = True
 
     def dbg_flags(self):
         if 'debug' not in self.dds_toolchain:
             return ''
 
         if self.dds_toolchain['debug'] == 'split':
-            return '/Zi /FS' if self.is_msvc else '-gsplit-dwarf'
+            return '/Zi /FS'
         elif self.dds_toolchain['debug'] == True or self.dds_toolchain['debug'] == 'embedded':
-            return '/Z7' if self.is_msvc else '-g'
+            return '/Z7'
         else:
             return ''
 
     def opt_flags(self):
         if self.dds_toolchain.get('optimize', False):
-            return '/O2' if self.is_msvc else '-O2'
+            return '/O2'
+        else:
+            return ''
 
     def rt_flags(self):
         if 'runtime' not in self.dds_toolchain:
             return ''
 
-        is_static = self.dds_toolchain['runtime'].get(
-            'static', True if self.is_msvc else False)
+        is_static = self.dds_toolchain['runtime'].get('static', True)
         is_debug = self.dds_toolchain['runtime'].get(
-            'debug', True if self.is_msvc and self.dds_toolchain.get('debug', True) else False)
-
-        if self.is_msvc:
-            TD = 'T' if is_static else 'D'
-            d = 'd' if is_debug else ''
-            return f'/M{TD}{d}'
-        elif self.is_gnu_like:
-            static = '-static-libgcc -static-libstdc++' if is_static else ''
-            debug = '-D_GLIBCXX_DEBUG -D_LIBCPP_DEBUG=1' if is_debug else ''
-            return f'{static} {debug}'
-        else:
-            return ''
+            'debug', bool(self.dds_toolchain.get('debug', True)))
+
+        TD = 'T' if is_static else 'D'
+        d = 'd' if is_debug else ''
+        return f'/M{TD}{d}'
+
+
+_FULL_CMAKE_COMPILE_GENERATORS = MappingProxyType({
+    'gnu': GnuLikeFullCMakeCompileToolchainGenerator,
+    'clang': GnuLikeFullCMakeCompileToolchainGenerator,
+    'msvc': MsvcFullCMakeCompileToolchainGenerator,
+})
 
 
 def generate_toolchain(dds_toolchain: DDSToolchain) -> str:
-    tcg = ExtractSDistToolchainGenerator(dds_toolchain)
-    tcg.generate()
-    return tcg.get()
+    return _generate(ExtractSDistToolchainGenerator, dds_toolchain)
 
 
 def generate_toolchain_for_full_cmake_compile(dds_toolchain: DDSToolchain) -> str:
-    tcg = FullCMakeCompileToolchainGenerator(dds_toolchain)
+    generator = _FULL_CMAKE_COMPILE_GENERATORS.get(
+        dds_toolchain.get('compiler_id'), FullCMakeCompileToolchainGenerator)
+    return _generate(generator, dds_toolchain)
+
+
+def _generate(generator: Type[ToolchainGenerator], dds_toolchain: DDSToolchain) -> str:
+    tcg = generator(dds_toolchain)
     tcg.generate()
     return tcg.get()
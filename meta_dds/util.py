@@ -7,15 +7,18 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from enum import Enum
 
 
-class IfExists(Enum):
+class IfExists(str, Enum):
+    '''
+    Members are also the strings given on the command line, so they compare
+    equal to them (`IfExists.FAIL == 'fail'`).
+    '''
     FAIL = 'fail'
     SKIP = 'ignore'
     REPLACE = 'replace'
 
 
 def del_nones(d: dict) -> dict:
-    for k, v in d.items():
-        if v is None:
-            del d[k]
-
-    return d
+    '''
+    Returns a copy of `d` without its None values.
+    '''
+    return {k: v for k, v in d.items() if v is not None}